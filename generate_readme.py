@@ -1,42 +1,89 @@
 """
-Plot roads of Vancouver, BC, colored by road suffix.
+Plot roads of several cities, colored by road suffix.
 Fraser Parlane 20230504
 """
-from road_names import RoadNames
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from road_names import RoadNames, BBox, _get_osm_files_cached
+from typing import Dict, Tuple
+import multiprocessing
 import logging
+import os
 
 # Set log level
 logging.basicConfig(level=logging.DEBUG)
 
+# The cities to plot: filename, bounding box, and legend position.
+cities = [
+    (
+        'vancouver',
+        dict(lon_min=-123.29, lon_max=-123.00, lat_min=49.23, lat_max=49.37),
+        (0.05, 0.3),
+    ),
+    (
+        'kelowna',
+        dict(lon_min=-119.65, lon_max=-119.34, lat_min=49.77, lat_max=49.98),
+        (0.05, 0.05),
+    ),
+    (
+        'lexington',
+        dict(lon_min=-84.65, lon_max=-84.35, lat_min=37.93, lat_max=38.13),
+        (0.05, 0.05),
+    ),
+    (
+        'sanfrancisco',
+        dict(lon_min=-122.63, lon_max=-122.24, lat_min=37.56, lat_max=37.91),
+        (0.05, 0.05),
+    ),
+    (
+        'newyork',
+        dict(lon_min=-74.04, lon_max=-73.82, lat_min=40.68, lat_max=40.87),
+        (0.05, 0.05),
+    ),
+]
 
-def run():
-    """Plot road names."""
 
-    logging.debug('\n\nVancouver, BC')
-    rn = RoadNames()
-    # rn.load_box(lon_min=-123.16, lon_max=-123.14, lat_min=49.27, lat_max=49.28)  # Small
-    rn.load_box(lon_min=-123.29, lon_max=-123.00, lat_min=49.23, lat_max=49.37)
-    rn.plot(filename='vancouver', legend_x=0.05, legend_y=0.3)
+def download_city(
+        name: str,
+        bbox: Dict[str, float],
+) -> None:
+    """Download the map data of a city, if not already cached."""
+    logging.debug('Downloading %s', name)
+    _get_osm_files_cached(bbox=BBox(**bbox))
 
-    logging.debug('\n\nKelowna, BC')
-    rn = RoadNames()
-    rn.load_box(lon_min=-119.65, lon_max=-119.34, lat_min=49.77, lat_max=49.98)
-    rn.plot(filename='kelowna', legend_x=0.05, legend_y=0.05)
 
-    logging.debug('\n\nLexington, Kentucky')
+def render_city(
+        name: str,
+        bbox: Dict[str, float],
+        legend: Tuple[float, float],
+) -> None:
+    """Plot road names of a city."""
+    logging.debug('Plotting %s', name)
     rn = RoadNames()
-    rn.load_box(lon_min=-84.65, lon_max=-84.35, lat_min=37.93, lat_max=38.13)
-    rn.plot(filename='lexington', legend_x=0.05, legend_y=0.05)
+    rn.load_box(**bbox)
+    rn.plot(filename=name, legend_x=legend[0], legend_y=legend[1])
 
-    logging.debug('\n\nSan Francisco, California')
-    rn = RoadNames()
-    rn.load_box(lon_min=-122.63, lon_max=-122.24, lat_min=37.56, lat_max=37.91)
-    rn.plot(filename='sanfrancisco', legend_x=0.05, legend_y=0.05)
 
-    logging.debug('\n\nNew York, New York')
-    rn = RoadNames()
-    rn.load_box(lon_min=-74.04, lon_max=-73.82, lat_min=40.68, lat_max=40.87)
-    rn.plot(filename='newyork', legend_x=0.05, legend_y=0.05)
+def run():
+    """
+    Plot road names. The downloads are network bound, so they run in threads.
+    Each city is rendered in its own process as soon as its download finishes.
+    The processes are spawned rather than forked, as forking while the download
+    threads run could copy a lock that one of them holds, such as logging's,
+    into the child.
+    """
+    spawn = multiprocessing.get_context('spawn')
+    with ThreadPoolExecutor(max_workers=len(cities)) as threads, \
+            ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=spawn) as processes:
+        downloads = {
+            threads.submit(download_city, name, bbox): (name, bbox, legend)
+            for name, bbox, legend in cities
+        }
+        renders = []
+        for download in as_completed(downloads):
+            download.result()
+            renders.append(processes.submit(render_city, *downloads[download]))
+        for render in renders:
+            render.result()
 
 
 if __name__ == '__main__':
@@ -1,64 +1,170 @@
-from dataclasses import dataclass
-from typing import Optional, List
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, partial
+from typing import Optional, List, Dict, Tuple, NamedTuple
 from lxml import etree, builder
-import xml.etree.cElementTree
 from cairosvg import svg2png
-import urllib.request
+from math import cos, pi, atan, sinh, asinh, tan, degrees, radians
+from itertools import chain
+from array import array
+import urllib.error
+import urllib.parse
+import http.client
+import threading
+import socket
+import time
 from tqdm import tqdm
 import pandas as pd
 import numpy as np
 import logging
+import hashlib
+import struct
+import shutil
+import tempfile
+import io
+import gzip
 import os
 
 
+logger = logging.getLogger(__name__)
+
+
 @dataclass
 class BBox:
+    """
+    Defines a bounding box to plot. Math is performed on these bounds for
+    plotting purposes. Derived values are computed on first use.
+    """
     lon_min: float
     lon_max: float
     lat_min: float
     lat_max: float
 
-    def __post_init__(self):
-        """
-        Defines a bounding box to plot. Math is performed on these bounds for
-        plotting purposes.
-        """
-
-        # Create standardized strings of lat, lon
-        self.lon_min_str = f'{self.lon_min:.4f}'
-        self.lon_max_str = f'{self.lon_max:.4f}'
-        self.lat_min_str = f'{self.lat_min:.4f}'
-        self.lat_max_str = f'{self.lat_max:.4f}'
-        self.id = f'{self.lon_min_str}_{self.lon_max_str}_{self.lat_min_str}_{self.lat_max_str}'
-
-        # Calculate map scaling values
-        self.lon_mid = (self.lon_min + self.lon_max) / 2
-        self.lat_mid = (self.lat_min + self.lat_max) / 2
-        self.lon_span = self.lon_max - self.lon_min
-        self.lat_span = self.lat_max - self.lat_min
-        self.lon_scale = np.cos(self.lat_mid * np.pi / 180)
-        self.htw_ratio = self.lat_span / (self.lon_span * self.lon_scale)
+    # Create standardized strings of lat, lon
+    @cached_property
+    def lon_min_str(self) -> str:
+        return f'{self.lon_min:.4f}'
+
+    @cached_property
+    def lon_max_str(self) -> str:
+        return f'{self.lon_max:.4f}'
+
+    @cached_property
+    def lat_min_str(self) -> str:
+        return f'{self.lat_min:.4f}'
+
+    @cached_property
+    def lat_max_str(self) -> str:
+        return f'{self.lat_max:.4f}'
+
+    @cached_property
+    def id(self) -> str:
+        return f'{self.lon_min_str}_{self.lon_max_str}_{self.lat_min_str}_{self.lat_max_str}'
+
+    # Calculate map scaling values
+    @cached_property
+    def lon_mid(self) -> float:
+        return (self.lon_min + self.lon_max) / 2
+
+    @cached_property
+    def lat_mid(self) -> float:
+        return (self.lat_min + self.lat_max) / 2
+
+    @cached_property
+    def lon_span(self) -> float:
+        return self.lon_max - self.lon_min
+
+    @cached_property
+    def lat_span(self) -> float:
+        return self.lat_max - self.lat_min
+
+    @cached_property
+    def lon_scale(self) -> float:
+        return cos(self.lat_mid * pi / 180)
+
+    @cached_property
+    def htw_ratio(self) -> float:
+        return self.lat_span / (self.lon_span * self.lon_scale)
+
+
+# The mean radius of the Earth, in metres.
+EARTH_RADIUS = 6371008.8
+
+# Ways are ordered along a Hilbert curve through a grid of 2 ** HILBERT_ORDER
+# cells on each side.
+HILBERT_ORDER = 16
+
+# OSM data is downloaded and cached in slippy-map tiles of this zoom level, which
+# are about 0.09 degrees of longitude wide.
+TILE_ZOOM = 12
+
+# The Overpass API endpoint, and the query sent to it. Only the ways tagged as
+# highways are requested, with their tags, plus the nodes they reference
+# (without metadata). XML is requested rather than JSON because it is streamed
+# by iterparse one element at a time, and each tile is only parsed once before
+# its arrays are cached; a JSON response would be decoded whole into memory.
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+OVERPASS_QUERY = """
+[out:xml][timeout:180];
+way["highway"]({lat_min},{lon_min},{lat_max},{lon_max});
+out body;
+>;
+out skel qt;
+"""
+
+# The number of tiles downloaded at once, across all threads. Overpass serves
+# two requests at a time per client by default.
+OVERPASS_SLOTS = 2
+
+# Requests that Overpass turns away because it is busy (429 Too Many Requests,
+# 504 Gateway Timeout) are retried this many times, waiting twice as long
+# before each retry, starting from OVERPASS_BACKOFF seconds.
+OVERPASS_RETRIES = 5
+OVERPASS_BACKOFF = 5.0
+
+# Seconds to wait on the Overpass socket before giving up on a request. This is
+# a little longer than the [timeout:180] of the query, so that Overpass times
+# out first. Requests that time out are closed and retried like busy ones.
+OVERPASS_SOCKET_TIMEOUT = 200
+
+
+def _osm_filepath(
+        bbox: BBox,
+) -> str:
+    """
+    Get the path of the cached OSM file for the given bounding box. The file is
+    named by a hash of the bounds (at the precision they are downloaded at) and
+    of the Overpass query, as a file downloaded with a different query holds
+    different data. Files are sharded into folders by the first characters of
+    the hash, so that no folder grows too large.
+    """
+    bounds = (bbox.lon_min_str, bbox.lon_max_str, bbox.lat_min_str, bbox.lat_max_str)
+    key = hashlib.blake2b(digest_size=12)
+    key.update(struct.pack('<4d', *map(float, bounds)))
+    key.update(OVERPASS_QUERY.encode())
+    key = key.hexdigest()
+    return f'osm/{key[:2]}/{key[2:4]}/{key}.osm.gz'
 
 
 def _get_osm_file_cached(
         bbox: BBox,
         use_cache: bool = True,
-) -> bytes:
+) -> str:
     """
     Get an OSM file from OpenStreetMaps for the given bounding box. If already
-    downloaded, return cached file.
+    downloaded, use the cached file. Return the path to the file so that it can
+    be streamed by the parser rather than read into memory.
     """
 
     # Check if file already exists
-    filename = f'map_{bbox.id}.osm'
-    filepath = f'osm/{filename}'
+    filepath = _osm_filepath(bbox=bbox)
     cache_available = True
     if use_cache:
-        logging.debug('Cached being used.')
+        logger.debug('Cached being used.')
         if os.path.isfile(filepath):
-            logging.debug(f'Cached file exists: {filepath}')
+            logger.debug('Cached file exists: %s', filepath)
         else:
-            logging.debug(f'Cached file {filepath} does not exist.')
+            logger.debug('Cached file %s does not exist.', filepath)
             cache_available = False
     else:
         cache_available = False
@@ -66,96 +172,353 @@ def _get_osm_file_cached(
     if not cache_available:
         _get_osm_file(bbox=bbox)
 
-    # Load and return
-    with open(filepath, 'rb') as f:
-        file = f.read()
-    return file
+    return filepath
 
 
-def _get_osm_file(
+def _tile_lon(
+        x: int,
+        zoom: int,
+) -> float:
+    """
+    Get the longitude of the west edge of slippy-map tile column x.
+    """
+    return x / 2 ** zoom * 360 - 180
+
+
+def _tile_lat(
+        y: int,
+        zoom: int,
+) -> float:
+    """
+    Get the latitude of the north edge of slippy-map tile row y.
+    """
+    return degrees(atan(sinh(pi * (1 - 2 * y / 2 ** zoom))))
+
+
+def _bbox_to_tiles(
         bbox: BBox,
-) -> None:
+        zoom: int = TILE_ZOOM,
+) -> List[BBox]:
     """
-    Download an OSM file from OpenStreetMaps for the given bounding box.
+    Cover a bounding box with the slippy-map tiles of a zoom level, and return
+    the bounding box of each tile. Tile edges are fixed, so overlapping or
+    slightly different boxes share tiles, and the cached files of those tiles.
     """
+    n = 2 ** zoom
+    x_min = int((bbox.lon_min + 180) / 360 * n)
+    x_max = int((bbox.lon_max + 180) / 360 * n)
+    y_min = int((1 - asinh(tan(radians(bbox.lat_max))) / pi) / 2 * n)
+    y_max = int((1 - asinh(tan(radians(bbox.lat_min))) / pi) / 2 * n)
+    return [
+        BBox(
+            lon_min=_tile_lon(x, zoom),
+            lon_max=_tile_lon(x + 1, zoom),
+            lat_min=_tile_lat(y + 1, zoom),
+            lat_max=_tile_lat(y, zoom),
+        )
+        for x in range(x_min, x_max + 1)
+        for y in range(y_min, y_max + 1)
+    ]
 
-    # Create osm folder
-    if not os.path.exists('osm'):
-        os.makedirs('osm')
 
-    # Download data
-    url_suffix = f'{bbox.lon_min_str},{bbox.lat_min_str},{bbox.lon_max_str},{bbox.lat_max_str}'
-    url = f'https://api.openstreetmap.org/api/0.6/map?bbox={url_suffix}'
+def _get_osm_files_cached(
+        bbox: BBox,
+        use_cache: bool = True,
+) -> List[str]:
+    """
+    Get the OSM files of the tiles that cover the given bounding box. Each tile
+    is downloaded, or found in the cache, on its own, and tiles are downloaded
+    concurrently, up to the Overpass slots shared by all downloads. Return the
+    paths to the files.
+    """
+    tiles = _bbox_to_tiles(bbox=bbox)
+    logger.debug('%s is covered by %d tiles.', bbox.id, len(tiles))
+    get_tile = partial(_get_osm_file_cached, use_cache=use_cache)
+    with ThreadPoolExecutor(max_workers=OVERPASS_SLOTS) as executor:
+        return list(executor.map(get_tile, tiles))
 
-    url = f'http://overpass.openstreetmap.ru/cgi/xapi_meta?*[bbox={url_suffix}]'
 
-    filepath = f'osm/map_{bbox.id}.osm'
-    logging.debug(f'Downloading {url}')
-    urllib.request.urlretrieve(url, filepath)
+# Each thread keeps its own connection to the Overpass API open between
+# downloads. Every download, from any thread, holds one of the Overpass slots.
+_connections = threading.local()
+_overpass_slots = threading.BoundedSemaphore(OVERPASS_SLOTS)
 
 
-@dataclass
-class Tag:
+def _overpass_post(
+        data: bytes,
+) -> http.client.HTTPResponse:
     """
-    A Tag describes a way of selecting objects from the OSM XML file. Tags are
-    used to create Views.
+    POST a query to the Overpass API over this thread's connection, and return
+    the response. The connection is kept alive, so the tiles of a box don't each
+    pay for a new TCP and TLS handshake. If Overpass is busy, the request is
+    retried with backoff. The response must be read in full before the next
+    request.
     """
-    k: str
-    v: Optional[str] = None
+    url = urllib.parse.urlsplit(OVERPASS_URL)
+    if getattr(_connections, 'overpass', None) is None:
+        _connections.overpass = http.client.HTTPSConnection(
+            url.netloc, timeout=OVERPASS_SOCKET_TIMEOUT)
+    connection = _connections.overpass
+    headers = {
+        'Accept-Encoding': 'gzip',
+        'Content-Type': 'application/x-www-form-urlencoded',
+    }
+    for attempt in range(OVERPASS_RETRIES + 1):
+        delay = OVERPASS_BACKOFF * 2 ** attempt
+        try:
+            try:
+                connection.request('POST', url.path, body=data, headers=headers)
+                response = connection.getresponse()
+            except (ConnectionResetError, BrokenPipeError):
+                # The server may have closed the connection while it was idle,
+                # in which case the request is sent again over a new one.
+                connection.close()
+                connection.request('POST', url.path, body=data, headers=headers)
+                response = connection.getresponse()
+        except socket.timeout:
+            # A stalled connection can't be reused, and would hold its slot.
+            connection.close()
+            if attempt == OVERPASS_RETRIES:
+                raise
+            logger.debug('Overpass timed out, retrying in %.0f s', delay)
+            time.sleep(delay)
+            continue
+        if response.status == 200:
+            return response
+        response.read()
+        if response.status not in (429, 504) or attempt == OVERPASS_RETRIES:
+            raise urllib.error.HTTPError(
+                OVERPASS_URL, response.status, response.reason, response.headers, None)
+        logger.debug('Overpass returned %d, retrying in %.0f s', response.status, delay)
+        time.sleep(delay)
+
+
+def _overpass_error(
+        osm_path: str,
+) -> Optional[str]:
+    """
+    Overpass reports a query that failed part way, such as by timing out or
+    running out of memory, as a successful response holding whatever data was
+    written so far and a <remark> that starts with "runtime error". Return the
+    text of such a remark in an OSM file, or None. The file is scanned as raw
+    bytes, as decompressing it is far cheaper than parsing it.
+    """
+    marker = b'<remark>'
+    with gzip.open(osm_path, 'rb') as f:
+        window = b''
+        while True:
+            chunk = f.read(2 ** 16)
+            if not chunk:
+                return None
+            window = window[-len(marker):] + chunk
+            start = window.find(marker)
+            if start >= 0:
+                remark = window[start + len(marker):]
+                while b'</remark>' not in remark and (chunk := f.read(2 ** 16)):
+                    remark += chunk
+                remark = remark.split(b'</remark>')[0].decode(errors='replace').strip()
+                if remark.startswith('runtime error'):
+                    return remark
+                window = b''
 
 
-def _way_has_tag(
-        way,
-        tag: Tag,
-) -> bool:
+def _get_osm_file(
+        bbox: BBox,
+) -> None:
     """
-    Check if a Way element has a Tag
+    Download an OSM file from the Overpass API for the given bounding box. The
+    response is requested gzipped, streamed to disk in chunks, and only moved
+    into the cache once complete so that an interrupted download is never
+    mistaken for a cached file.
     """
 
-    # Check for tag in each child
-    for child in way.getchildren():
-        if child.tag != 'tag':
-            continue
-        if child.get('k') != tag.k:
-            continue
-        if tag.v is not None and child.get('v') != tag.v:
-            continue
-        return True
+    # Download data
+    query = OVERPASS_QUERY.format(
+        lon_min=bbox.lon_min_str,
+        lon_max=bbox.lon_max_str,
+        lat_min=bbox.lat_min_str,
+        lat_max=bbox.lat_max_str,
+    )
+    data = urllib.parse.urlencode({'data': query}).encode()
+
+    # Create the cache folder, and a uniquely named file to download into.
+    # Downloads may run concurrently.
+    filepath = _osm_filepath(bbox=bbox)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    fd, partpath = tempfile.mkstemp(dir=os.path.dirname(filepath), suffix='.part')
+    os.close(fd)
+
+    logger.debug('Downloading %s for %s', OVERPASS_URL, bbox.id)
+    try:
+        # The slot is held until the response has been read in full.
+        with _overpass_slots:
+            response = _overpass_post(data)
+
+            # A gzipped response is already in the format of the cache, so it
+            # is stored as it arrives. Otherwise, compress it on the way to
+            # disk.
+            if response.headers.get('Content-Encoding') == 'gzip':
+                f = open(partpath, 'wb')
+            else:
+                f = gzip.open(partpath, 'wb')
+            with f:
+                shutil.copyfileobj(response, f, length=2 ** 16)
+
+        # Don't cache the partial data of a failed query.
+        error = _overpass_error(partpath)
+        if error is not None:
+            raise RuntimeError(f'Overpass query for {bbox.id} failed: {error}')
+        os.replace(partpath, filepath)
+    except Exception:
+        # Don't reuse a connection with a response left unread.
+        _connections.overpass.close()
+        raise
+    finally:
+        if os.path.exists(partpath):
+            os.remove(partpath)
+
+
+def _parse_osm(
+        osm_path: str,
+) -> Dict[str, np.ndarray]:
+    """
+    Stream an OSM file in one pass into a struct of arrays. Nodes are stored as
+    arrays of id / lon / lat. Ways are stored as their IDs, their node refs
+    packed end to end with offsets, and a flat table of (way, key, value) tag
+    rows, with the keys and values interned to integer IDs into the returned
+    keys and values arrays. Each element is cleared (along with its already-read
+    siblings) once read, so the parsed tree never grows. Raise if the file holds
+    the runtime error of a failed Overpass query.
+    """
+    logger.debug('Parsing %s', osm_path)
+    node_ids = array('q')
+    node_lon = array('d')
+    node_lat = array('d')
+    way_ids = array('q')
+    way_refs = array('q')
+    way_offsets = array('q', [0])
+    tag_way = array('i')
+    tag_k = array('i')
+    tag_v = array('i')
+    key_ids: Dict[str, int] = {}
+    value_ids: Dict[str, int] = {}
+    with gzip.open(osm_path, 'rb') as f:
+        # OSM has no xml:id attributes, entities or meaningful whitespace, so
+        # skip the parser's work for each.
+        elements = etree.iterparse(
+            f,
+            events=('end',),
+            tag=('node', 'way', 'remark'),
+            huge_tree=True,
+            collect_ids=False,
+            remove_blank_text=True,
+            resolve_entities=False,
+        )
+        for _, element in tqdm(elements):
+            if element.tag == 'node':
+                node_ids.append(int(element.get('id')))
+                node_lon.append(float(element.get('lon')))
+                node_lat.append(float(element.get('lat')))
+            elif element.tag == 'remark':
+                # A failed query holds partial data, which must not be cached.
+                remark = (element.text or '').strip()
+                if remark.startswith('runtime error'):
+                    raise RuntimeError(
+                        f'{osm_path} holds a failed Overpass query: {remark}. '
+                        f'Delete it to download it again.')
+            else:
+                way_idx = len(way_ids)
+                way_ids.append(int(element.get('id')))
+                way_refs.extend([int(nd.get('ref')) for nd in element.iterchildren('nd')])
+                way_offsets.append(len(way_refs))
+                for tag in element.iterchildren('tag'):
+                    tag_way.append(way_idx)
+                    tag_k.append(key_ids.setdefault(tag.get('k'), len(key_ids)))
+                    tag_v.append(value_ids.setdefault(tag.get('v'), len(value_ids)))
+
+            # Free the element, and any siblings that have been read.
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    return {
+        'node_ids': np.frombuffer(node_ids, dtype=np.int64),
+        'node_lon': np.frombuffer(node_lon, dtype=np.float64),
+        'node_lat': np.frombuffer(node_lat, dtype=np.float64),
+        'way_ids': np.frombuffer(way_ids, dtype=np.int64),
+        'way_refs': np.frombuffer(way_refs, dtype=np.int64),
+        'way_offsets': np.frombuffer(way_offsets, dtype=np.int64),
+        'tag_way': np.frombuffer(tag_way, dtype=np.int32),
+        'tag_k': np.frombuffer(tag_k, dtype=np.int32),
+        'tag_v': np.frombuffer(tag_v, dtype=np.int32),
+        'keys': np.array(list(key_ids), dtype=str),
+        'values': np.array(list(value_ids), dtype=str),
+    }
+
+
+def _parse_osm_cached(
+        osm_path: str,
+        use_cache: bool = True,
+) -> Dict[str, np.ndarray]:
+    """
+    Get the parsed arrays of an OSM file. The arrays of each file are cached as
+    a folder of .npy files beside it, which are memory mapped when read, so a
+    cached file is loaded without parsing or copying.
+    """
+    parsed_path = osm_path.replace('.osm.gz', '.parsed')
+    if (
+        use_cache
+        and os.path.isdir(parsed_path)
+        and os.path.getmtime(parsed_path) >= os.path.getmtime(osm_path)
+    ):
+        logger.debug('Cached parsed arrays exist: %s', parsed_path)
+        return {
+            filename[:-len('.npy')]: np.load(os.path.join(parsed_path, filename), mmap_mode='r')
+            for filename in os.listdir(parsed_path)
+        }
 
-    # If not found, return False
-    return False
+    # Write the arrays to a new folder, and swap it into place once complete.
+    parsed = _parse_osm(osm_path)
+    partpath = tempfile.mkdtemp(dir=os.path.dirname(osm_path), suffix='.part')
+    try:
+        for name, values in parsed.items():
+            np.save(os.path.join(partpath, f'{name}.npy'), values)
+        shutil.rmtree(parsed_path, ignore_errors=True)
+        os.replace(partpath, parsed_path)
+    finally:
+        shutil.rmtree(partpath, ignore_errors=True)
+    return parsed
 
 
-def _way_has_tags(
-        way,
-        tags: List[Tag],
-) -> bool:
+class Tag(NamedTuple):
     """
-    Check if a Way element has a Tag
+    A Tag describes a way of selecting objects from the OSM XML file. Tags are
+    used to create Views. As a tuple, a Tag has no per-instance dict and can be
+    used as a dict key.
     """
-    for tag in tags:
-        if not _way_has_tag(way, tag):
-            return False
-    return True
+    k: str
+    v: Optional[str] = None
 
 
-def _way_not_has_tags(
-        way,
-        tags: List[Tag],
-) -> bool:
+def _select_packed(
+        offsets: np.ndarray,
+        selection: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Check if a Way element has none of the listed tags
-    :param way: The Way to check for a Tag
-    :param tags: The Tags to look for
-    :return: bool
+    Items are stored packed end to end in a flat array, with item i spanning
+    [offsets[i], offsets[i + 1]). Return the positions in the flat array of
+    the elements of the selected items, and the offsets of the selected items
+    packed end to end.
     """
-    for tag in tags:
-        if _way_has_tag(way, tag):
-            return False
-    return True
+    starts = offsets[selection]
+    lengths = offsets[selection + 1] - starts
+    new_offsets = np.zeros(len(selection) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    positions = np.arange(new_offsets[-1]) + np.repeat(starts - new_offsets[:-1], lengths)
+    return positions, new_offsets
 
 
-@dataclass
+@dataclass(slots=True)
 class View:
     """
     A View is used to select objects from the OSM XML file. A View is defined by
@@ -164,30 +527,123 @@ class View:
     true_tags: Optional[List[Tag]] = None
     false_tags: Optional[List[Tag]] = None
 
+    # Attributes set in __post_init__, declared here so that they have slots.
+    ways: np.ndarray = field(init=False, repr=False, compare=False)
+    true_ids: List[Tuple[int, int]] = field(init=False, repr=False, compare=False)
+    false_ids: List[Tuple[int, int]] = field(init=False, repr=False, compare=False)
+    xs: np.ndarray = field(init=False, repr=False, compare=False)
+    ys: np.ndarray = field(init=False, repr=False, compare=False)
+    offsets: np.ndarray = field(init=False, repr=False, compare=False)
+
     def __post_init__(self):
-        # These ways are valid for this View
-        self.ways = []
+        # The indices of the ways that are valid for this View
+        self.ways = np.empty(0, dtype=np.int64)
         if self.true_tags is None:
             self.true_tags = []
         if self.false_tags is None:
             self.false_tags = []
 
-        # A place to store the way_ids and way_lonlat
-        self.way_ids: List[List[int]] = []
-        self.way_lonlat: List[pd.DataFrame] = []
+        # The Tags translated to interned (key, pair) IDs, once loaded.
+        self.true_ids = []
+        self.false_ids = []
 
-    def test_and_add_way(
-            self,
-            way,
-    ) -> None:
-        """
-        Test if a Way meets the criteria for this View. If so, add it.
-        """
-        if not _way_has_tags(way, self.true_tags):
-            return None
-        if not _way_not_has_tags(way, self.false_tags):
-            return None
-        self.ways.append(way)
+        # A place to store the pixel positions of every way packed end to end.
+        # Way i spans xs[offsets[i]:offsets[i + 1]].
+        self.xs = np.empty(0, dtype=np.int16)
+        self.ys = np.empty(0, dtype=np.int16)
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+
+def _match_tags(
+        tag_way: np.ndarray,
+        tag_k: np.ndarray,
+        tag_pair: np.ndarray,
+        n_ways: int,
+        predicates: List[Tuple[int, int]],
+) -> np.ndarray:
+    """
+    Match tag predicates against a (way, key, pair) tag table, where pair is
+    the interned ID of the (key, value) pair of the row. Predicates are
+    interned (key, pair) IDs; a pair ID of -1 matches any value, and negative
+    IDs otherwise match nothing. Return a (predicates, ways) boolean matrix of
+    which ways have each predicate. Each tag row looks up the predicate of its
+    pair, and of its key, in an array indexed by ID, so the table is scanned
+    once for predicates with a value and once for those without, however many
+    predicates there are.
+    """
+    has_tag = np.zeros((len(predicates), n_ways), dtype=bool)
+    exact = [(i, pair) for i, (k, pair) in enumerate(predicates) if k >= 0 and pair >= 0]
+    any_value = [(i, k) for i, (k, pair) in enumerate(predicates) if k >= 0 and pair == -1]
+    for indexed_ids, table_ids in ((exact, tag_pair), (any_value, tag_k)):
+        if not indexed_ids:
+            continue
+        n_ids = max([int(table_ids.max()) if len(table_ids) else 0] + [i for _, i in indexed_ids]) + 1
+        predicate_rows = np.full(n_ids, -1, dtype=np.int64)
+        for row, i in indexed_ids:
+            predicate_rows[i] = row
+        rows = predicate_rows[table_ids]
+        hit = rows >= 0
+        has_tag[rows[hit], tag_way[hit]] = True
+    return has_tag
+
+
+def _hilbert_index(
+        x: np.ndarray,
+        y: np.ndarray,
+        order: int = HILBERT_ORDER,
+) -> np.ndarray:
+    """
+    Get the distance along a Hilbert curve through a 2 ** order square grid of
+    each cell (x, y). Cells that are close on the curve are close in the grid.
+    """
+    n = 1 << order
+    x = np.asarray(x, dtype=np.int64)
+    y = np.asarray(y, dtype=np.int64)
+    d = np.zeros(len(x), dtype=np.int64)
+    for s in (1 << np.arange(order - 1, -1, -1)).tolist():
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+
+        # Rotate the quadrant, so that the curve within it is in the standard
+        # orientation.
+        flip = rx & ~ry
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+    return d
+
+
+def _to_pixels(
+        values: np.ndarray,
+) -> np.ndarray:
+    """
+    Round pixel positions to whole pixels, as fractions of a pixel are not
+    visible, and store them as int16. Positions far outside the window are
+    clipped to the int16 range.
+    """
+    info = np.iinfo(np.int16)
+    return np.rint(values).clip(info.min, info.max).astype(np.int16)
+
+
+def _drop_repeated_points(
+        xs: np.ndarray,
+        ys: np.ndarray,
+        offsets: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Drop the points of packed paths that land on the same pixel as the point
+    before them, as they draw nothing. The first and last point of each path
+    are kept. Return the remaining xs, ys and their offsets.
+    """
+    keep = np.ones(len(xs), dtype=bool)
+    keep[1:] = (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])
+    nonempty = offsets[:-1] < offsets[1:]
+    keep[offsets[:-1][nonempty]] = True
+    keep[offsets[1:][nonempty] - 1] = True
+    kept_before = np.zeros(len(xs) + 1, dtype=np.int64)
+    np.cumsum(keep, out=kept_before[1:])
+    return xs[keep], ys[keep], kept_before[offsets]
 
 
 def _xy_to_svg_d(
@@ -195,12 +651,10 @@ def _xy_to_svg_d(
         y: np.ndarray,
 ) -> str:
     """
-    Convert x, y pixel coordinates to an SVG d string.
+    Convert x, y integer pixel coordinates to an SVG d string.
     """
-    d = f'M {x[0]} {y[0]}'
-    for ix, iy in zip(x[1:], y[1:]):
-        d += f' L {ix} {iy}'
-    return d
+    points = [f'{ix} {iy}' for ix, iy in zip(x.tolist(), y.tolist())]
+    return 'M ' + ' L '.join(points)
 
 
 class RoadNames:
@@ -213,11 +667,28 @@ class RoadNames:
         """
         self.bbox: Optional[BBox] = None
         self.use_cache = use_cache
-        self.osm: Optional[bytes] = None
-        self.xml: Optional[etree.Element] = None
+        self.osm_paths: List[str] = []
         self.views: List[View] = []
-        self.ways: List = []
-        self.id_table: Optional[pd.DataFrame] = None
+        self.way_ids: Optional[np.ndarray] = None
+        self.way_nodes: Optional[np.ndarray] = None
+        self.way_offsets: Optional[np.ndarray] = None
+        self.way_bbox: Optional[np.ndarray] = None
+        self.way_length: Optional[np.ndarray] = None
+        self.way_centroid: Optional[np.ndarray] = None
+        self.way_lon_order: Optional[np.ndarray] = None
+        self.way_lon_min: Optional[np.ndarray] = None
+        self.way_lon_span: float = 0.0
+        self.tag_way: Optional[np.ndarray] = None
+        self.tag_k: Optional[np.ndarray] = None
+        self.tag_v: Optional[np.ndarray] = None
+        self.tag_pair: Optional[np.ndarray] = None
+        self.pair_codes: Optional[np.ndarray] = None
+        self.key_ids: Dict[str, int] = {}
+        self.value_ids: Dict[str, int] = {}
+        self.value_names: List[str] = []
+        self.node_ids: Optional[np.ndarray] = None
+        self.node_lon: Optional[np.ndarray] = None
+        self.node_lat: Optional[np.ndarray] = None
         self.width: Optional[int] = None
         self.height: Optional[int] = None
         self.filename: Optional[str] = None
@@ -239,11 +710,24 @@ class RoadNames:
             lat_max=lat_max,
         )
 
+        # Locate the OSM files of the tiles that cover the box
+        self.osm_paths = _get_osm_files_cached(bbox=self.bbox, use_cache=self.use_cache)
+
         # Load the map data into memory
-        self._read_osm()
+        way_refs, ids, lons, lats = self._read_osm()
 
         # Create a table of ids, lat and lon.
-        self._create_id_lat_lon_table()
+        self._create_id_lat_lon_table(ids=ids, lons=lons, lats=lats)
+
+        # Resolve the node IDs of every way to rows of the node table once, so
+        # that Views only need to gather by position.
+        self.way_nodes = self._node_rows(way_refs)
+        self._way_stats()
+        self._sort_ways()
+        self._index_ways()
+
+        # Translate the Tags of any Views loaded so far.
+        self._compile_views(self.views)
 
     def load_views(
             self,
@@ -253,88 +737,344 @@ class RoadNames:
         Provide a list of views to visualize.
         """
         self.views += list(views)
+        if self.way_ids is not None:
+            self._compile_views(views)
 
-    def _read_osm(self):
+    def _tag_ids(
+            self,
+            tag: Tag,
+    ) -> Tuple[int, int]:
         """
-        Load the OSM file into memory. Convert into an XML for parsing.
+        Translate a Tag to the interned IDs of its key and of its (key, value)
+        pair. A pair ID of -1 matches any value. Keys and pairs that are not in
+        the OSM file translate to -2, which matches nothing.
         """
-        # Load OSM
-        self.osm = _get_osm_file_cached(bbox=self.bbox)
-
-        # Convert to XML
-        logging.debug('Converting OSM to XML.')
-        self.xml = etree.fromstring(self.osm)
-        self.cxml = xml.etree.cElementTree.fromstring(self.osm)
+        k_id = self.key_ids.get(tag.k, -2)
+        if tag.v is None:
+            return k_id, -1
+        v_id = self.value_ids.get(tag.v, -2)
+        if k_id < 0 or v_id < 0:
+            return k_id, -2
+        code = k_id * len(self.value_ids) + v_id
+        pair_id = int(np.searchsorted(self.pair_codes, code))
+        if pair_id == len(self.pair_codes) or self.pair_codes[pair_id] != code:
+            return k_id, -2
+        return k_id, pair_id
+
+    def _compile_views(
+            self,
+            views: List[View],
+    ) -> None:
+        """
+        Translate the Tags of each View to interned IDs, so that matching them
+        against the tag table only compares integers.
+        """
+        for view in views:
+            view.true_ids = [self._tag_ids(tag) for tag in view.true_tags]
+            view.false_ids = [self._tag_ids(tag) for tag in view.false_tags]
 
-    def _create_id_lat_lon_table(self):
+    def _read_osm(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Read the parsed arrays of each OSM file, and join them. The keys and
+        values of each file are interned to the IDs shared by all files. Ways
+        that cross tiles are in several files, and are only kept once. The node
+        IDs of the ways, packed end to end, are returned to be resolved to rows
+        of the node table, along with the id / lon / lat of each node; these may
+        hold the same node more than once.
+        """
+        logger.debug('Reading nodes and ways from OSM.')
+        parsed = [_parse_osm_cached(path, use_cache=self.use_cache) for path in self.osm_paths]
+
+        # Shift the offsets and way indices of each file past those of the
+        # files before it, and translate the key and value IDs.
+        way_offsets = [np.zeros(1, dtype=np.int64)]
+        tag_way, tag_k, tag_v = [], [], []
+        n_refs = 0
+        n_ways = 0
+        for arrays in parsed:
+            key_map = np.array([
+                self.key_ids.setdefault(key, len(self.key_ids)) for key in arrays['keys'].tolist()
+            ], dtype=np.int32)
+            value_map = np.array([
+                self.value_ids.setdefault(value, len(self.value_ids)) for value in arrays['values'].tolist()
+            ], dtype=np.int32)
+            way_offsets.append(arrays['way_offsets'][1:] + n_refs)
+            tag_way.append(arrays['tag_way'] + np.int32(n_ways))
+            tag_k.append(key_map[arrays['tag_k']])
+            tag_v.append(value_map[arrays['tag_v']])
+            n_refs += len(arrays['way_refs'])
+            n_ways += len(arrays['way_ids'])
+        self.way_ids = np.concatenate([arrays['way_ids'] for arrays in parsed])
+        way_refs = np.concatenate([arrays['way_refs'] for arrays in parsed])
+        self.way_offsets = np.concatenate(way_offsets)
+        self.tag_way = np.concatenate(tag_way)
+        self.tag_k = np.concatenate(tag_k)
+        self.tag_v = np.concatenate(tag_v)
+        self.value_names = list(self.value_ids)
+
+        # Keep the first copy of each way.
+        _, first = np.unique(self.way_ids, return_index=True)
+        if len(first) < len(self.way_ids):
+            keep = np.sort(first)
+            positions, self.way_offsets = _select_packed(self.way_offsets, keep)
+            way_refs = way_refs[positions]
+            self.way_ids = self.way_ids[keep]
+            kept = np.zeros(n_ways, dtype=bool)
+            kept[keep] = True
+            tag_rows = kept[self.tag_way]
+            self.tag_way = np.searchsorted(keep, self.tag_way[tag_rows]).astype(np.int32)
+            self.tag_k = self.tag_k[tag_rows]
+            self.tag_v = self.tag_v[tag_rows]
+
+        # Intern each (key, value) pair, numbered in order of code.
+        codes = self.tag_k.astype(np.int64) * len(self.value_ids) + self.tag_v
+        self.pair_codes, tag_pair = np.unique(codes, return_inverse=True)
+        self.tag_pair = tag_pair.astype(np.int32)
+
+        # Join the nodes of every file
+        ids = np.concatenate([arrays['node_ids'] for arrays in parsed])
+        lons = np.concatenate([arrays['node_lon'] for arrays in parsed])
+        lats = np.concatenate([arrays['node_lat'] for arrays in parsed])
+        return way_refs, ids, lons, lats
+
+    def _create_id_lat_lon_table(
+            self,
+            ids: np.ndarray,
+            lons: np.ndarray,
+            lats: np.ndarray,
+    ):
         """
         Each way consists of a list of IDs. These IDs correspond to nodes in the
-        XML file. Create a table of IDs, lat, and lon to quickly convert IDs.
+        XML file. Create a table of IDs, lat, and lon, as arrays sorted by ID, to
+        quickly convert IDs.
+        """
+        logger.debug('Creating id / lat / lon table.')
+
+        # The arrays are used without copying if the IDs are already sorted and
+        # unique. Otherwise, sort them and drop nodes that are listed more than
+        # once, such as those shared by neighbouring tiles.
+        self.node_ids = np.asarray(ids, dtype=np.int64)
+        self.node_lon = np.asarray(lons, dtype=np.float64)
+        self.node_lat = np.asarray(lats, dtype=np.float64)
+        if np.any(self.node_ids[1:] <= self.node_ids[:-1]):
+            self.node_ids, first = np.unique(self.node_ids, return_index=True)
+            self.node_lon = self.node_lon[first]
+            self.node_lat = self.node_lat[first]
+
+    def _node_rows(
+            self,
+            ids: np.ndarray,
+    ) -> np.ndarray:
+        """
+        Convert an array of node IDs to their rows in the id / lat / lon table
+        with a single binary search over the sorted IDs.
+        """
+        rows = np.searchsorted(self.node_ids, ids)
+        rows = np.minimum(rows, len(self.node_ids) - 1)
+        missing = self.node_ids[rows] != ids
+        if missing.any():
+            raise KeyError(f'Nodes not in the OSM file: {ids[missing]}')
+        return rows
+
+    def _way_stats(self):
+        """
+        Measure every way in one pass over its packed nodes: its bounding box,
+        as rows of (lon_min, lat_min, lon_max, lat_max), its length along the
+        ground in metres, and its centroid, as rows of the mean (lon, lat) of
+        its nodes. Ways without nodes have NaN bounds and centroids, and so fall
+        outside of any box.
+        """
+        lons = self.node_lon[self.way_nodes]
+        lats = self.node_lat[self.way_nodes]
+        starts = self.way_offsets[:-1]
+        nonempty = self.way_offsets[1:] > starts
+        starts = starts[nonempty]
+
+        # The haversine distance from each node to the one before it. The
+        # first node of each way has no segment.
+        lon_rad = np.radians(lons)
+        lat_rad = np.radians(lats)
+        segments = np.zeros(len(lons))
+        h = (
+            np.sin(np.diff(lat_rad) / 2) ** 2
+            + np.cos(lat_rad[:-1]) * np.cos(lat_rad[1:]) * np.sin(np.diff(lon_rad) / 2) ** 2
+        )
+        segments[1:] = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
+        segments[starts] = 0
+
+        self.way_bbox = np.full((len(self.way_ids), 4), np.nan)
+        self.way_bbox[nonempty, 0] = np.minimum.reduceat(lons, starts)
+        self.way_bbox[nonempty, 1] = np.minimum.reduceat(lats, starts)
+        self.way_bbox[nonempty, 2] = np.maximum.reduceat(lons, starts)
+        self.way_bbox[nonempty, 3] = np.maximum.reduceat(lats, starts)
+        self.way_length = np.zeros(len(self.way_ids))
+        self.way_length[nonempty] = np.add.reduceat(segments, starts)
+        counts = np.diff(self.way_offsets)[nonempty]
+        self.way_centroid = np.full((len(self.way_ids), 2), np.nan)
+        self.way_centroid[nonempty, 0] = np.add.reduceat(lons, starts) / counts
+        self.way_centroid[nonempty, 1] = np.add.reduceat(lats, starts) / counts
+
+    def _sort_ways(self):
+        """
+        Reorder the ways along a Hilbert curve through their centroids, so that
+        ways that are close on the map are close in memory, and the ways in a
+        box are gathered from a few runs of the arrays. Ways without nodes are
+        moved to the end. The tag table is reordered to match.
+        """
+        has_nodes = ~np.isnan(self.way_centroid[:, 0])
+        low = np.min(self.way_centroid, axis=0, initial=np.inf, where=has_nodes[:, None])
+        high = np.max(self.way_centroid, axis=0, initial=-np.inf, where=has_nodes[:, None])
+        cells = np.zeros((len(self.way_ids), 2), dtype=np.int64)
+        if has_nodes.any():
+            # Centroids that all share a lon or lat have no span to scale, and
+            # all lie in the first cell of that axis.
+            span = high - low
+            scale = np.divide((1 << HILBERT_ORDER) - 1, span, out=np.zeros_like(span), where=span > 0)
+            cells[has_nodes] = (self.way_centroid[has_nodes] - low) * scale
+        order = np.lexsort((_hilbert_index(cells[:, 0], cells[:, 1]), ~has_nodes))
+
+        # Gather the ways, and their measurements, in the new order.
+        positions, self.way_offsets = _select_packed(self.way_offsets, order)
+        self.way_nodes = self.way_nodes[positions]
+        self.way_ids = self.way_ids[order]
+        self.way_bbox = self.way_bbox[order]
+        self.way_length = self.way_length[order]
+        self.way_centroid = self.way_centroid[order]
+
+        # Point the tag rows at the new way indices, and keep them grouped by
+        # way.
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        tag_way = rank[self.tag_way]
+        tag_order = np.argsort(tag_way, kind='stable')
+        self.tag_way = tag_way[tag_order].astype(np.int32)
+        self.tag_k = self.tag_k[tag_order]
+        self.tag_v = self.tag_v[tag_order]
+        self.tag_pair = self.tag_pair[tag_order]
+
+    def _index_ways(self):
+        """
+        Index the ways by the west edge of their bounding boxes. Together with
+        the widest way, this bounds the range of ways that can overlap any box,
+        which is found by binary search.
         """
-        logging.debug('Creating id / lat / lon table.')
+        self.way_lon_order = np.argsort(self.way_bbox[:, 0], kind='stable')
+        self.way_lon_min = self.way_bbox[self.way_lon_order, 0]
+        spans = self.way_bbox[:, 2] - self.way_bbox[:, 0]
+        self.way_lon_span = float(np.max(spans, initial=0.0, where=~np.isnan(spans)))
 
-        # Walk the tree, and add all relevant id / lat / lon
-        id_dict = {
-            'id': [],
-            'lon': [],
-            'lat': [],
-        }
-        for child in tqdm(self.cxml.iter()):
-            if child.tag == 'node':
-                id_dict['id'].append(child.get('id'))
-                id_dict['lon'].append(child.get('lon'))
-                id_dict['lat'].append(child.get('lat'))
+    def _ways_in_box(
+            self,
+            bbox: BBox,
+    ) -> np.ndarray:
+        """
+        Get the indices, in order, of the ways whose bounding boxes overlap a
+        box.
+        """
+        start = np.searchsorted(self.way_lon_min, bbox.lon_min - self.way_lon_span, side='left')
+        stop = np.searchsorted(self.way_lon_min, bbox.lon_max, side='right')
+        candidates = self.way_lon_order[start:stop]
+        way_bbox = self.way_bbox[candidates]
+        overlaps = (
+            (way_bbox[:, 2] >= bbox.lon_min)
+            & (way_bbox[:, 1] <= bbox.lat_max)
+            & (way_bbox[:, 3] >= bbox.lat_min)
+        )
+        return np.sort(candidates[overlaps])
 
-        # Make Pandas table
-        dtypes = {'id': int, 'lon': float, 'lat': float}
-        self.id_table = pd.DataFrame(id_dict)
-        self.id_table = self.id_table.astype(dtypes)
-        self.id_table.sort_values(by=['id'], inplace=True)
-        self.id_table.set_index('id', inplace=True)
+    def _way_values(
+            self,
+            k: str,
+    ) -> np.ndarray:
+        """
+        Return the value ID of the key k for every way, or -1 where a way does
+        not have the key.
+        """
+        values = np.full(len(self.way_ids), -1, dtype=np.int32)
+        rows = self.tag_k == self.key_ids.get(k, -1)
+        values[self.tag_way[rows]] = self.tag_v[rows]
+        return values
 
-    def _select_ways(self):
+    def _way_suffixes(self) -> np.ndarray:
         """
-        the OSM tree contains several object types. We are only interested in
-        the objects labelled way. Isolate these for easy iteration.
+        Return the suffix of the name of every way (e.g., Street), or 'unknown'
+        where a way has no name. Many ways share a name, so each distinct name
+        is only split once.
         """
-        logging.debug('Selecting way objects from XML.')
-        for child in self.xml.getchildren():
-            if child.tag == 'way':
-                self.ways.append(child)
+        name_ids = self._way_values('name')
+        distinct, inverse = np.unique(name_ids, return_inverse=True)
+        suffixes = np.array([
+            'unknown' if name_id < 0 else self.value_names[name_id].split(' ')[-1]
+            for name_id in distinct
+        ], dtype=object)
+        return suffixes[inverse]
 
     def _process_views(self):
         """
         For each of the views, add the relevant Ways.
         """
 
-        logging.debug('Processing views.')
-        for view in tqdm(self.views):
-
-            # Find the Way elements that are relevant to the View, and add them.
-            for way in self.ways:
-                view.test_and_add_way(way)
-
-            # Now that all the relevant Ways have been added, extract the IDs
-            # of the relevant waypoints into a list of lists.
-            for way in view.ways:
-                way_ids = []
-                for child in way.getchildren():
-                    if child.tag == 'nd':
-                        way_ids.append(int(child.get('ref')))
-                view.way_ids.append(way_ids)
-
-            # Look up these IDs and convert them to lon/lat pairs.
-            for id_list in view.way_ids:
-                view.way_lonlat.append(self.id_table.loc[id_list])
+        logger.debug('Processing views.')
+
+        # The tiles loaded cover more than the box, so only the ways that
+        # overlap it are considered. Only their tag rows are matched.
+        ways = self._ways_in_box(self.bbox)
+        in_box = np.zeros(len(self.way_ids), dtype=bool)
+        in_box[ways] = True
+        tag_rows = in_box[self.tag_way]
+
+        # Match the tags of every View against the tag table in one batch.
+        predicates = list(dict.fromkeys(chain.from_iterable(
+            view.true_ids + view.false_ids for view in self.views)))
+        has_tag = _match_tags(
+            tag_way=np.searchsorted(ways, self.tag_way[tag_rows]),
+            tag_k=self.tag_k[tag_rows],
+            tag_pair=self.tag_pair[tag_rows],
+            n_ways=len(ways),
+            predicates=predicates,
+        )
+        predicate_rows = {predicate: i for i, predicate in enumerate(predicates)}
 
-        # convert the lat, lon to a pixel position. Many of these values will
-        # land outside the window range as they are a part of paths that pass
-        # through the window.
+        # Find the ways that are relevant to each View.
         for view in self.views:
-            for df in view.way_lonlat:
-                df['x'] = (df['lon'] - self.bbox.lon_min) / self.bbox.lon_span * self.width
-                y = (df['lat'] - self.bbox.lat_min) / self.bbox.lat_span * self.height
-                df['y'] = self.height - y
+            valid = np.ones(len(ways), dtype=bool)
+            for tag_ids in view.true_ids:
+                valid &= has_tag[predicate_rows[tag_ids]]
+            for tag_ids in view.false_ids:
+                valid &= ~has_tag[predicate_rows[tag_ids]]
+            view.ways = ways[valid]
+
+        # Look up the waypoints of the ways of every View at once and convert
+        # them to lon/lat pairs. The ways are kept packed end to end, View
+        # after View, delimited by offsets.
+        counts = np.array([len(view.ways) for view in self.views], dtype=np.int64)
+        positions, offsets = _select_packed(
+            self.way_offsets,
+            np.concatenate([view.ways for view in self.views] + [np.zeros(0, dtype=np.int64)]),
+        )
+        rows = self.way_nodes[positions]
+        lons = self.node_lon[rows]
+        lats = self.node_lat[rows]
+
+        # convert the lat, lon to a pixel position. Many of these values
+        # will land outside the window range as they are a part of paths
+        # that pass through the window.
+        x_scale = self.width / self.bbox.lon_span
+        y_scale = self.height / self.bbox.lat_span
+        xs = _to_pixels((lons - self.bbox.lon_min) * x_scale)
+        ys = _to_pixels(self.height - (lats - self.bbox.lat_min) * y_scale)
+
+        # Nodes closer together than a pixel can't be told apart, so only one
+        # point is kept for each pixel a way passes through in a row.
+        xs, ys, offsets = _drop_repeated_points(xs, ys, offsets)
+
+        # Hand each View its slice of the waypoints.
+        way_starts = np.concatenate([[0], np.cumsum(counts)])
+        for view, way_start, way_stop in zip(self.views, way_starts[:-1], way_starts[1:]):
+            view_offsets = offsets[way_start:way_stop + 1]
+            view.xs = xs[view_offsets[0]:view_offsets[-1]]
+            view.ys = ys[view_offsets[0]:view_offsets[-1]]
+            view.offsets = view_offsets - view_offsets[0]
 
     def _preprocess(
             self,
@@ -349,9 +1089,6 @@ class RoadNames:
         self.width = width
         self.height = int(self.width * self.bbox.htw_ratio)
 
-        # Select ways from the osm data
-        self._select_ways()
-
         # Process the Views so that they contain the correct Ways
         self._process_views()
 
@@ -373,23 +1110,31 @@ class RoadNames:
             views.append(View(true_tags=[tag]))
         self.load_views(views=views)
 
-    def log_highway_types(self):
-        types = {}
-        for child in self.cxml.iter():
-            if child.tag == 'way':
-                for attrib in child.iter():
-                    if attrib.tag != 'tag':
-                        continue
-                    if attrib.get('k') != 'highway':
-                        continue
-                    value = attrib.get('v')
-                    if value in types.keys():
-                        types[value] += 1
-                    else:
-                        types[value] = 1
-        df = pd.DataFrame(data={'type': types.keys(), 'count': types.values()})
+    def _highway_types(self) -> pd.DataFrame:
+        """
+        Count the ways of each highway type in the box, and their total length,
+        most common first. Whole tiles are loaded, so ways outside the box are
+        left out, as they are when plotting.
+        """
+        in_box = np.zeros(len(self.way_ids), dtype=bool)
+        in_box[self._ways_in_box(self.bbox)] = True
+        rows = (self.tag_k == self.key_ids.get('highway', -1)) & in_box[self.tag_way]
+        value_ids, inverse, counts = np.unique(
+            self.tag_v[rows], return_inverse=True, return_counts=True)
+        lengths = np.bincount(
+            inverse, weights=self.way_length[self.tag_way[rows]], minlength=len(value_ids))
+        df = pd.DataFrame(data={
+            'type': [self.value_names[value_id] for value_id in value_ids],
+            'count': counts,
+            'km': lengths / 1000,
+        })
         df.sort_values(by=['count'], inplace=True, ascending=False)
-        logging.debug(df)
+        return df
+
+    def log_highway_types(self):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        logger.debug('%s', self._highway_types())
 
 
     def plot(
@@ -417,7 +1162,6 @@ class RoadNames:
 
         # Generate SVG objects
         elements = builder.ElementMaker()
-        svg = elements.svg
         path = elements.path
         rect = elements.rect
         text = elements.text
@@ -438,114 +1182,132 @@ class RoadNames:
             'Way': '#004645',
         }
 
-        # Create a document with a grey background
-        # Create document with white background
-        doc = svg(
-            xmlns="http://www.w3.org/2000/svg",
-            height=str(self.height),
-            width=str(self.width),
-        )
-        doc.append(rect(
-            x='0',
-            y='0',
-            width=str(self.width),
-            height=str(self.height),
-            fill='#202020',
-        ))
+        # The SVG is streamed to disk (or to memory if only a PNG is wanted) so
+        # that each element is written out and freed as soon as it is made.
+        if as_svg:
+            if not os.path.exists('svg'):
+                os.mkdir('svg')
+            svg_target = f'svg/{self.filename}.svg'
+        else:
+            svg_target = io.BytesIO()
+
+        # The color of roads whose suffix has no color.
+        color_unknown = '#303030'
 
         # Create a place to store suffix usage.
         color_missing = {}
         color_used = {}
 
-        # Iterate through the views
-        logging.debug('Plotting')
-        for view in tqdm(self.views):
-
-            # Iterate through the ways
-            for df, way in zip(view.way_lonlat, view.ways):
-                d = _xy_to_svg_d(
-                    x=df['x'].to_numpy(),
-                    y=df['y'].to_numpy(),
-                )
-
-                # Get the suffix of the street
-                suffix = 'unknown'
-                for child in way.getchildren():
-                    if child.tag != 'tag':
-                        continue
-                    if child.get('k') != 'name':
-                        continue
-                    name = child.get('v')
-                    suffix = name.split(' ')[-1]
-
-                # Get color
-                try:
-                    color = colors[suffix]
+        logger.debug('Plotting')
+        with etree.xmlfile(svg_target, encoding='utf-8') as xf:
+            xf.write_declaration()
 
-                    # Log usage
-                    if suffix in color_used.keys():
-                        color_used[suffix] += 1
-                    else:
-                        color_used[suffix] = 1
-                except KeyError:
-
-                    # Log missing color
-                    if suffix in color_missing.keys():
-                        color_missing[suffix] += 1
-                    else:
-                        color_missing[suffix] = 1
-
-                    color = '#303030'
-
-                # Make path and append
-                p = path(
-                    d=d,
-                    style=f'fill:none;stroke-width:1;stroke:{color};stroke-opacity:1;',
-                )
-                doc.append(p)
-
-        # Plot the legend.
-        # First sort colors by usage
-        colors_sorted = sorted(color_used.items(), key=lambda x: x[1])[::-1]
-        legend_x_abs = self.width * legend_x
-        legend_y_abs = self.height * legend_y
-        y_offset = 20
-        line_length = 30
-        for i, (suffix, count) in enumerate(colors_sorted):
-
-            # Plot line
-            color = colors[suffix]
-            d = f'M {legend_x_abs} {legend_y_abs + i * y_offset} l {line_length} 0 z'
-            p = path(
-                d=d,
-                style=f'fill:none;stroke-width:2;stroke:{color};'
+            # Create a document with a grey background
+            doc = xf.element(
+                'svg',
+                xmlns="http://www.w3.org/2000/svg",
+                height=str(self.height),
+                width=str(self.width),
             )
-            doc.append(p)
-
-            # Text
-            t = text(
-                x=str(legend_x_abs + line_length + 10),
-                y=str(legend_y_abs + i * y_offset + 7),
-                style=f'fill:{color};',
-            )
-            t.attrib['font-size'] = '18px'
-            t.text = suffix
-            doc.append(t)
-
-        # Save to disk
-        logging.debug('Saving to disk.')
-        svg_string = etree.tostring(doc, pretty_print=True)
-        if as_svg:
-            if not os.path.exists('svg'):
-                os.mkdir('svg')
-            with open(f'svg/{self.filename}.svg', 'wb') as f:
-                f.write(svg_string)
-
+            with doc:
+                xf.write('\n')
+                xf.write(rect(
+                    x='0',
+                    y='0',
+                    width=str(self.width),
+                    height=str(self.height),
+                    fill='#202020',
+                ), pretty_print=True)
+
+                # Iterate through the views
+                suffixes = self._way_suffixes()
+                for view in tqdm(self.views):
+
+                    # Iterate through the ways, collecting the subpaths of
+                    # each color so that a color is drawn as a single path.
+                    # Ways without a color are drawn first, so that they never
+                    # cover colored ones.
+                    color_paths = {color_unknown: []}
+                    for i, way_idx in enumerate(view.ways):
+                        start, end = view.offsets[i], view.offsets[i + 1]
+                        d = _xy_to_svg_d(
+                            x=view.xs[start:end],
+                            y=view.ys[start:end],
+                        )
+
+                        # Get the suffix of the street
+                        suffix = suffixes[way_idx]
+
+                        # Get color
+                        try:
+                            color = colors[suffix]
+
+                            # Log usage
+                            if suffix in color_used.keys():
+                                color_used[suffix] += 1
+                            else:
+                                color_used[suffix] = 1
+                        except KeyError:
+
+                            # Log missing color
+                            if suffix in color_missing.keys():
+                                color_missing[suffix] += 1
+                            else:
+                                color_missing[suffix] = 1
+
+                            color = color_unknown
+
+                        color_paths.setdefault(color, []).append(d)
+
+                    # Make paths and write
+                    for color, ds in color_paths.items():
+                        if not ds:
+                            continue
+                        p = path(
+                            d=' '.join(ds),
+                            style=f'fill:none;stroke-width:1;stroke:{color};stroke-opacity:1;',
+                        )
+                        xf.write(p, pretty_print=True)
+
+                # Plot the legend.
+                # First sort colors by usage
+                colors_sorted = sorted(color_used.items(), key=lambda x: x[1])[::-1]
+                legend_x_abs = self.width * legend_x
+                legend_y_abs = self.height * legend_y
+                y_offset = 20
+                line_length = 30
+                for i, (suffix, count) in enumerate(colors_sorted):
+
+                    # Plot line
+                    color = colors[suffix]
+                    d = f'M {legend_x_abs} {legend_y_abs + i * y_offset} l {line_length} 0 z'
+                    p = path(
+                        d=d,
+                        style=f'fill:none;stroke-width:2;stroke:{color};'
+                    )
+                    xf.write(p, pretty_print=True)
+
+                    # Text
+                    t = text(
+                        x=str(legend_x_abs + line_length + 10),
+                        y=str(legend_y_abs + i * y_offset + 7),
+                        style=f'fill:{color};',
+                    )
+                    t.attrib['font-size'] = '18px'
+                    t.text = suffix
+                    xf.write(t, pretty_print=True)
+
+        # Render the PNG from the streamed SVG
         if as_png:
+            logger.debug('Saving PNG to disk.')
             if not os.path.exists('png'):
                 os.mkdir('png')
+            if as_svg:
+                svg_source = {'url': svg_target}
+            else:
+                svg_source = {'bytestring': svg_target.getvalue()}
             svg2png(
-                bytestring=svg_string,
+                **svg_source,
                 write_to=f'png/{self.filename}.png',
                 scale=2,
             )
@@ -1,7 +1,18 @@
-from road_names import RoadNames, BBox, View, Tag, _get_osm_file_cached
+from road_names import (
+    RoadNames, BBox, View, Tag, _get_osm_file_cached, _xy_to_svg_d, _select_packed,
+    _to_pixels, _match_tags, _osm_filepath, _bbox_to_tiles, _drop_repeated_points,
+    _hilbert_index, _overpass_error, _parse_osm,
+)
+from functools import lru_cache
+from typing import Dict, Tuple
+import numpy as np
 import unittest
 import logging
+import tempfile
+import warnings
 import shutil
+import gzip
+import copy
 import os
 
 
@@ -29,6 +40,30 @@ large_area = {
 }
 
 
+@lru_cache(maxsize=None)
+def _load_area_once(
+        area: Tuple[Tuple[str, float], ...],
+) -> RoadNames:
+    """
+    Load an area once for all the tests that use it.
+    """
+    rn = RoadNames()
+    rn.load_box(**dict(area))
+    return rn
+
+
+def load_area(
+        area: Dict[str, float],
+) -> RoadNames:
+    """
+    Get a RoadNames with an area loaded, and no Views. The map data is shared
+    with other tests and must not be changed, but Views may be added.
+    """
+    rn = copy.copy(_load_area_once(tuple(sorted(area.items()))))
+    rn.views = []
+    return rn
+
+
 class TestRoadNames(unittest.TestCase):
 
     def test_get_osm_file_cached(self):
@@ -45,10 +80,247 @@ class TestRoadNames(unittest.TestCase):
         # Test cached
         _get_osm_file_cached(bbox=bbox)
 
-    def test_load_box(self):
+    def test_xy_to_svg_d(self):
+        x = _to_pixels(np.array([0, 10.25, 20.5, 1e6]))
+        y = _to_pixels(np.array([5, 15, 25.04, -1e6]))
+        d = _xy_to_svg_d(x=x, y=y)
+        self.assertEqual(d, 'M 0 5 L 10 15 L 20 25 L 32767 -32768')
 
+    def test_select_packed(self):
+        offsets = np.array([0, 2, 5, 6])
+        positions, new_offsets = _select_packed(offsets, np.array([0, 2]))
+        self.assertListEqual(positions.tolist(), [0, 1, 5])
+        self.assertListEqual(new_offsets.tolist(), [0, 2, 3])
+
+    def test_drop_repeated_points(self):
+        xs = np.array([0, 0, 0, 1, 1, 5, 5, 5, 7], dtype=np.int16)
+        ys = np.array([0, 0, 0, 1, 1, 5, 5, 5, 7], dtype=np.int16)
+        offsets = np.array([0, 3, 5, 5, 8, 9])
+        xs, ys, offsets = _drop_repeated_points(xs, ys, offsets)
+        self.assertListEqual(xs.tolist(), [0, 0, 1, 1, 5, 5, 7])
+        self.assertListEqual(ys.tolist(), [0, 0, 1, 1, 5, 5, 7])
+        self.assertListEqual(offsets.tolist(), [0, 2, 4, 4, 6, 7])
+
+    def test_hilbert_index(self):
+        # The first order curve visits the cells of a square in a U.
+        d = _hilbert_index(np.array([0, 0, 1, 1]), np.array([0, 1, 1, 0]), order=1)
+        self.assertListEqual(d.tolist(), [0, 1, 2, 3])
+
+        # Higher orders visit every cell once, stepping to a neighbour each time.
+        x, y = np.meshgrid(np.arange(16), np.arange(16))
+        d = _hilbert_index(x.ravel(), y.ravel(), order=4)
+        self.assertListEqual(sorted(d.tolist()), list(range(256)))
+        path = np.stack([x.ravel(), y.ravel()], axis=1)[np.argsort(d)]
+        self.assertTrue((np.abs(np.diff(path, axis=0)).sum(axis=1) == 1).all())
+
+    def test_sort_ways(self):
+        # Ways whose centroids share a lon or lat, such as a single way, have
+        # no span to scale along that axis.
         rn = RoadNames()
-        rn.load_box(**small_area)
+        rn.way_ids = np.array([1, 2])
+        rn.way_offsets = np.array([0, 2, 4])
+        rn.way_nodes = np.array([0, 1, 2, 3])
+        rn.way_centroid = np.array([[5.0, 1.0], [5.0, 2.0]])
+        rn.way_bbox = np.zeros((2, 4))
+        rn.way_length = np.zeros(2)
+        rn.tag_way = np.array([0, 1], dtype=np.int32)
+        rn.tag_k = rn.tag_v = rn.tag_pair = np.zeros(2, dtype=np.int32)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            rn._sort_ways()
+        self.assertListEqual(rn.way_ids.tolist(), [1, 2])
+
+    def test_match_tags(self):
+        tag_way = np.array([0, 0, 1, 2, 2])
+        tag_k = np.array([0, 1, 0, 0, 1])
+        tag_pair = np.array([0, 1, 2, 0, 3])
+        predicates = [(0, 0), (1, -1), (1, 3), (0, -2), (-2, -1)]
+        has_tag = _match_tags(tag_way, tag_k, tag_pair, 4, predicates)
+        self.assertListEqual(has_tag.tolist(), [
+            [True, False, True, False],
+            [True, False, True, False],
+            [False, False, True, False],
+            [False, False, False, False],
+            [False, False, False, False],
+        ])
+
+        # Pairs beyond those in the table match nothing.
+        has_tag = _match_tags(tag_way, tag_k, tag_pair, 4, [(0, 5)])
+        self.assertFalse(has_tag.any())
+
+    def test_osm_filepath(self):
+        path = _osm_filepath(BBox(**small_area))
+        self.assertEqual(path, _osm_filepath(BBox(**small_area)))
+        self.assertNotEqual(path, _osm_filepath(BBox(**med_area)))
+
+        # Bounds are downloaded to 4 decimal places, and keyed the same way.
+        nudged_area = dict(small_area, lon_min=small_area['lon_min'] + 1e-6)
+        self.assertEqual(path, _osm_filepath(BBox(**nudged_area)))
+
+    def test_overpass_error(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'failed.osm.gz')
+            with gzip.open(path, 'wb') as f:
+                f.write(
+                    b'<osm><node id="1" lat="0" lon="0"/>'
+                    + b' ' * 2 ** 17
+                    + b'<remark> runtime error: Query timed out. </remark></osm>'
+                )
+            self.assertEqual(_overpass_error(path), 'runtime error: Query timed out.')
+            with self.assertRaises(RuntimeError):
+                _parse_osm(path)
+
+            with gzip.open(path, 'wb') as f:
+                f.write(b'<osm><remark> runtime remark: Note. </remark></osm>')
+            self.assertIsNone(_overpass_error(path))
+            self.assertEqual(len(_parse_osm(path)['way_ids']), 0)
+
+    def test_read_osm_tiles(self):
+        tiles = [
+            b'''<osm>
+                <node id="1" lat="0.1" lon="0.1"/>
+                <node id="2" lat="0.2" lon="0.2"/>
+                <node id="3" lat="0.3" lon="0.3"/>
+                <way id="10"><nd ref="1"/><nd ref="2"/>
+                    <tag k="highway" v="residential"/><tag k="name" v="A Street"/></way>
+                <way id="11"><nd ref="2"/><nd ref="3"/>
+                    <tag k="surface" v="asphalt"/></way>
+            </osm>''',
+            b'''<osm>
+                <node id="2" lat="0.2" lon="0.2"/>
+                <node id="3" lat="0.3" lon="0.3"/>
+                <node id="4" lat="0.4" lon="0.4"/>
+                <way id="12"><nd ref="3"/><nd ref="4"/>
+                    <tag k="lanes" v="2"/></way>
+                <way id="10"><nd ref="1"/><nd ref="2"/>
+                    <tag k="name" v="A Street"/><tag k="highway" v="residential"/></way>
+            </osm>''',
+        ]
+        expected = {
+            10: ({'highway': 'residential', 'name': 'A Street'}, [1, 2]),
+            11: ({'surface': 'asphalt'}, [2, 3]),
+            12: ({'lanes': '2'}, [3, 4]),
+        }
+        with tempfile.TemporaryDirectory() as folder:
+            osm_paths = []
+            for i, tile in enumerate(tiles):
+                osm_paths.append(os.path.join(folder, f'{i}.osm.gz'))
+                with gzip.open(osm_paths[-1], 'wb') as f:
+                    f.write(tile)
+
+            # Load once from the OSM files, and once from the parsed cache.
+            loads = []
+            for _ in range(2):
+                rn = RoadNames()
+                rn.osm_paths = osm_paths
+                with self.assertLogs('road_names', level='DEBUG') as logs:
+                    way_refs, ids, lons, lats = rn._read_osm()
+                rn._create_id_lat_lon_table(ids=ids, lons=lons, lats=lats)
+                rn.way_nodes = rn._node_rows(way_refs)
+                loads.append(rn)
+            self.assertEqual(sum('Cached parsed arrays exist' in line for line in logs.output), 2)
+
+            for rn in loads:
+                keys = list(rn.key_ids)
+                ways = {}
+                for way_idx, way_id in enumerate(rn.way_ids.tolist()):
+                    rows = rn.tag_way == way_idx
+                    tags = {
+                        keys[k]: rn.value_names[v]
+                        for k, v in zip(rn.tag_k[rows].tolist(), rn.tag_v[rows].tolist())
+                    }
+                    start, end = rn.way_offsets[way_idx], rn.way_offsets[way_idx + 1]
+                    ways[way_id] = (tags, rn.node_ids[rn.way_nodes[start:end]].tolist())
+                self.assertDictEqual(ways, expected)
+                self.assertListEqual(rn.node_ids.tolist(), [1, 2, 3, 4])
+                np.testing.assert_array_equal(
+                    rn.pair_codes[rn.tag_pair],
+                    rn.tag_k.astype(np.int64) * len(rn.value_ids) + rn.tag_v,
+                )
+
+            first, cached = loads
+            for name in (
+                    'way_ids', 'way_offsets', 'way_nodes', 'tag_way', 'tag_k', 'tag_v',
+                    'tag_pair', 'pair_codes', 'node_ids', 'node_lon', 'node_lat'):
+                np.testing.assert_array_equal(getattr(first, name), getattr(cached, name))
+            self.assertDictEqual(first.key_ids, cached.key_ids)
+            self.assertDictEqual(first.value_ids, cached.value_ids)
+
+    def test_bbox_to_tiles(self):
+        bbox = BBox(**large_area)
+        tiles = _bbox_to_tiles(bbox, zoom=12)
+
+        # The tiles cover the box, and each is one 4096th of the world wide.
+        self.assertLessEqual(min(t.lon_min for t in tiles), bbox.lon_min)
+        self.assertGreaterEqual(max(t.lon_max for t in tiles), bbox.lon_max)
+        self.assertLessEqual(min(t.lat_min for t in tiles), bbox.lat_min)
+        self.assertGreaterEqual(max(t.lat_max for t in tiles), bbox.lat_max)
+        for tile in tiles:
+            self.assertAlmostEqual(tile.lon_span, 360 / 2 ** 12)
+
+        # A box inside a tile is covered by that tile alone.
+        inner = tiles[0]
+        self.assertEqual(_bbox_to_tiles(BBox(
+            lon_min=inner.lon_min + 0.01,
+            lon_max=inner.lon_max - 0.01,
+            lat_min=inner.lat_min + 0.01,
+            lat_max=inner.lat_max - 0.01,
+        ), zoom=12), [inner])
+
+    def test_way_stats(self):
+        rn = RoadNames()
+        rn.node_lon = np.array([0.0, 0.5, 1.0, 10.0, 10.0])
+        rn.node_lat = np.array([0.0, 0.0, 0.0, 40.0, 41.0])
+        rn.way_ids = np.array([1, 2, 3])
+        rn.way_nodes = np.array([0, 1, 2, 3, 4])
+        rn.way_offsets = np.array([0, 3, 3, 5])
+        rn._way_stats()
+
+        # One degree along the equator, nothing, and one degree of latitude.
+        np.testing.assert_allclose(rn.way_length, [111195.08, 0, 111195.08], rtol=1e-6)
+        np.testing.assert_array_equal(rn.way_bbox[[0, 2]], [[0, 0, 1, 0], [10, 40, 10, 41]])
+        np.testing.assert_array_equal(rn.way_centroid[[0, 2]], [[0.5, 0], [10, 40.5]])
+        self.assertTrue(np.isnan(rn.way_bbox[1]).all())
+
+    def test_ways_in_box(self):
+        rng = np.random.default_rng(0)
+        corners = rng.uniform(0, 1, (500, 2, 2))
+        rn = RoadNames()
+        rn.way_bbox = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1)
+        rn.way_bbox[::50] = np.nan
+        rn._index_ways()
+
+        bbox = BBox(lon_min=0.2, lon_max=0.3, lat_min=0.6, lat_max=0.9)
+        overlaps = (
+            (rn.way_bbox[:, 0] <= bbox.lon_max)
+            & (rn.way_bbox[:, 2] >= bbox.lon_min)
+            & (rn.way_bbox[:, 1] <= bbox.lat_max)
+            & (rn.way_bbox[:, 3] >= bbox.lat_min)
+        )
+        np.testing.assert_array_equal(rn._ways_in_box(bbox), np.flatnonzero(overlaps))
+
+    def test_highway_types(self):
+        rn = RoadNames()
+        rn.bbox = BBox(lon_min=0, lon_max=1, lat_min=0, lat_max=1)
+        rn.way_ids = np.array([1, 2, 3])
+        rn.way_bbox = np.array([[0.2, 0.2, 0.4, 0.4], [5, 5, 6, 6], [0.5, 0.5, 2, 2]])
+        rn.way_length = np.array([1000.0, 5000.0, 3000.0])
+        rn._index_ways()
+        rn.key_ids = {'highway': 0, 'name': 1}
+        rn.value_names = ['residential', 'motorway', 'Main Street']
+        rn.tag_way = np.array([0, 0, 1, 2], dtype=np.int32)
+        rn.tag_k = np.array([0, 1, 0, 0], dtype=np.int32)
+        rn.tag_v = np.array([0, 2, 1, 0], dtype=np.int32)
+
+        # The motorway lies outside the box, and is not counted.
+        df = rn._highway_types()
+        self.assertListEqual(df['type'].tolist(), ['residential'])
+        self.assertListEqual(df['count'].tolist(), [2])
+        self.assertListEqual(df['km'].tolist(), [4.0])
+
+    def test_load_box(self):
+        rn = load_area(small_area)
+        self.assertGreater(len(rn.way_ids), 0)
 
     def test_load_views(self):
         rn = RoadNames()
@@ -57,13 +329,11 @@ class TestRoadNames(unittest.TestCase):
         rn.load_views(views=[view])
 
     def test_generate_views(self):
-        rn = RoadNames()
-        rn.load_box(**small_area)
+        rn = load_area(small_area)
         rn.generate_views()
 
     def test_preprocess(self):
-        rn = RoadNames()
-        rn.load_box(**small_area)
+        rn = load_area(small_area)
         tag = Tag(k='highway')
         view = View(true_tags=[tag])
         rn.load_views(views=[view])
@@ -72,12 +342,10 @@ class TestRoadNames(unittest.TestCase):
         self.assertLessEqual(len(rn.views[0].ways), 1000)
 
     def test_print_highway_types(self):
-        rn = RoadNames()
-        rn.load_box(**med_area)
+        rn = load_area(med_area)
         rn.log_highway_types()
 
     def test_plot(self):
-        rn = RoadNames()
-        rn.load_box(**large_area)
+        rn = load_area(large_area)
         rn.generate_views()
         rn.plot()